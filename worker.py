@@ -1,28 +1,81 @@
 import logging
 import os
+import re
 import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from pathlib import Path
 from functools import wraps
 from typing import Any, Dict, List
 
+import orjson
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 session = requests.Session()
 session.headers["User-Agent"] = "github.com/bored-engineer/hackeroni-slack-disclosure-bot"
+# Retry transient gateway errors from HackerOne, the GraphQL query is idempotent
+session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=4,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.2,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=["GET", "POST"],
+            raise_on_status=False,
+        ),
+    ),
+)
+
+# Kept separate from the HackerOne session so the CSRF token isn't sent to Slack
+slack_session = requests.Session()
+SLACK_WEBHOOK_URL = os.environ["SLACK_WEBHOOK_URL"]
+
+# Only the CSRF token is needed from the page, so a full HTML parse is overkill
+CSRF_TOKEN_RE = re.compile(rb'<meta[^>]+name="csrf-token"[^>]+content="([^"]+)"')
 
 # TODO: Don't hard-code this URL, fetch at launch?
 LOGO_URL = "https://profile-photos.hackerone-user-content.com/variants/000/000/013/fa942b9b1cbf4faf37482bf68458e1195aab9c02_original.png/0621f211aae8984f02f017decf83d0064fe91a6a16b11f840ecf5b53ddb7b872"
 
+# Attachment keys that are the same for every message
+ATTACHMENT_BASE = {
+    "footer": "HackerOne Disclosure Bot",
+    "footer_icon": LOGO_URL,
+    "mrkdwn_in": ["text", "pretext"],
+}
+
+# Extracted from the H1 UI to match
+SEVERITY_COLORS = {
+    "New": "#8e44ad",
+    "Triaged": "#e67e22",
+    "Resolved": "#609828",
+    "Not Applicable": "#ce3f4b",
+    "Informative": "#ccc",
+    "Duplicate": "#a78260",
+    "Spam": "#555",
+}
+
+# How many report IDs to remember so they aren't posted twice
+SEEN_MAX = 4096
+
+# The GraphQL query never changes, so only read it from disk once
+QUERY = (Path(__file__).parent / "query.graphql").read_text()
+
+# Pre-serialize the static parts of the request body, only "since" varies per poll
+QUERY_BODY_PREFIX = b'{"query":' + orjson.dumps(QUERY) + b',"variables":{"since":"'
+QUERY_BODY_SUFFIX = b'"}}'
+
 
 def refresh_csrf():
     """Refresh the CSRF token for the session by requesting a webpage and parsing it."""
     response = session.get("https://hackerone.com/hacktivity")
     response.raise_for_status()
-    soup = BeautifulSoup(response.text, features="html.parser")
-    csrf_token = soup.select_one('meta[name="csrf-token"]')["content"]
-    session.headers["x-csrf-token"] = csrf_token
+    csrf_token = CSRF_TOKEN_RE.search(response.content).group(1)
+    session.headers["x-csrf-token"] = csrf_token.decode()
 
 
 def fetch_hacktivity(since: datetime) -> List[Any]:
@@ -30,21 +83,24 @@ def fetch_hacktivity(since: datetime) -> List[Any]:
     # Make a POST using query.graphql
     response = session.post(
         "https://hackerone.com/graphql",
-        json={
-            "query": (Path(__file__).parent / "query.graphql").read_text(),
-            "variables": {
-                "since": since.isoformat(),
-            },
-        },
+        data=QUERY_BODY_PREFIX + since.isoformat().encode() + QUERY_BODY_SUFFIX,
+        headers={"Content-Type": "application/json"},
     )
     # If there's still an error, raise it and give up
     response.raise_for_status()
     # Filter the results to only the "Disclosed" objects, ignore everything else
-    nodes = response.json()["data"]["hacktivity_items"]["nodes"]
+    nodes = orjson.loads(response.content)["data"]["hacktivity_items"]["nodes"]
     nodes = filter(lambda node: node["__typename"] == "Disclosed", nodes)
     return list(nodes)
 
 
+def absolute_url(url: str) -> str:
+    """Qualify a relative HackerOne URL, leaving absolute URLs untouched."""
+    if url.startswith(("https://", "http://")):
+        return url
+    return "https://hackerone.com" + url
+
+
 def post_slack(payload: dict):
     # All reporters have a username, some have an actual name as well
     reporter_name = payload["reporter"]["username"]
@@ -52,20 +108,16 @@ def post_slack(payload: dict):
         reporter_name = payload["reporter"]["name"] + f" ({reporter_name})"
 
     # The reporter profile picture may not be a fully qualified URL
-    reporter_picture = payload["reporter"]["profile_picture"]
-    if not reporter_picture.startswith("http"):
-        reporter_picture = "https://hackerone.com" + reporter_picture
+    reporter_picture = absolute_url(payload["reporter"]["profile_picture"])
 
     # Build up the attachment from the fields
     attachment = {
+        **ATTACHMENT_BASE,
         "author_name": reporter_name,
         "author_link": payload["reporter"]["url"],
         "author_icon": reporter_picture,
         "title": f'Report {payload["report"]["_id"]}: {payload["report"]["title"]}',
         "title_link": payload["report"]["url"],
-        "footer": "HackerOne Disclosure Bot",
-        "footer_icon": LOGO_URL,
-        "mrkdwn_in": ["text", "pretext"],
         "fields": [],
         "fallback": f'"{payload["report"]["title"]}" - {payload["report"]["url"]}',
     }
@@ -81,21 +133,9 @@ def post_slack(payload: dict):
                 "short": True,
             }
         )
-        # Extracted from the H1 UI to match
-        if severity == "New":
-            attachment["color"] = "#8e44ad"
-        elif severity == "Triaged":
-            attachment["color"] = "#e67e22"
-        elif severity == "Resolved":
-            attachment["color"] = "#609828"
-        elif severity == "Not Applicable":
-            attachment["color"] = "#ce3f4b"
-        elif severity == "Informative":
-            attachment["color"] = "#ccc"
-        elif severity == "Duplicate":
-            attachment["color"] = "#a78260"
-        elif severity == "Spam":
-            attachment["color"] = "#555"
+        color = SEVERITY_COLORS.get(severity)
+        if color:
+            attachment["color"] = color
 
     # If there was a rewarded amount, add that as a field
     if payload["total_awarded_amount"]:
@@ -111,31 +151,33 @@ def post_slack(payload: dict):
 
     # Match the timestamp in Slack to the actual disclosure date
     if payload["report"]["disclosed_at"]:
-        disclosed_at_iso = payload["report"]["disclosed_at"].rstrip("Z")
+        # Keep the UTC offset so timestamp() doesn't assume local time
+        disclosed_at_iso = payload["report"]["disclosed_at"].replace("Z", "+00:00")
         disclosed_at_unix = datetime.fromisoformat(disclosed_at_iso).timestamp()
         attachment["timestamp"] = disclosed_at_unix
 
     # The team profile picture may not be a fully qualified URL
-    team_picture = payload["team"]["profile_picture"]
-    if not team_picture.startswith("http"):
-        team_picture = "https://hackerone.com" + team_picture
+    team_picture = absolute_url(payload["team"]["profile_picture"])
 
     # Fire the attachment off to slack as a payload
-    response = requests.post(
-        url=os.environ["SLACK_WEBHOOK_URL"],
-        json={
-            "username": f'{payload["team"]["name"]} disclosed',
-            "icon_url": team_picture,
-            "attachments": [attachment],
-        },
+    response = slack_session.post(
+        SLACK_WEBHOOK_URL,
+        data=orjson.dumps(
+            {
+                "username": f'{payload["team"]["name"]} disclosed',
+                "icon_url": team_picture,
+                "attachments": [attachment],
+            }
+        ),
+        headers={"Content-Type": "application/json"},
     )
     response.raise_for_status()
 
 
 def main():
     """worker entrypoint."""
-    # This is just going to grow unconditionally, oh well
-    seen = set()
+    # Bounded LRU of report IDs, far more than fit in a 15 minute window
+    seen = OrderedDict()
     # Loop forever until we get SIGINT (KeyboardInterrupt)
     while True:
         try:
@@ -156,8 +198,11 @@ def main():
                 report_id = event["report"]["_id"]
                 if report_id in seen:
                     logging.info(f"Ignoring {report_id} as it was already seen...")
+                    seen.move_to_end(report_id)
                     continue
-                seen.add(report_id)
+                seen[report_id] = None
+                if len(seen) > SEEN_MAX:
+                    seen.popitem(last=False)
                 # Post the event to Slack
                 logging.info(f"Posting {report_id} to Slack...")
                 post_slack(event)